@@ -1,10 +1,43 @@
 import os
+import inspect
+import heapq
 from pathlib import Path
 import itertools
+import numpy as np
 import torch
 import torch.nn.functional as F
 
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from transformers import GPT2LMHeadModel
+
+try:
+    # the Rust backed tokenizer encodes a whole batch of prompts at once
+    from transformers import GPT2TokenizerFast as GPT2Tokenizer
+except ImportError:
+    from transformers import GPT2Tokenizer
+
+try:
+    # generate() with custom stopping criteria, newer transformers only
+    from transformers import GenerationConfig, StoppingCriteria, StoppingCriteriaList
+except ImportError:
+    GenerationConfig = StoppingCriteriaList = None
+    StoppingCriteria = object
+
+try:
+    # the cache object newer transformers want instead of tuples of tensors
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+try:
+    import onnxruntime
+except ModuleNotFoundError:
+    onnxruntime = None
+
+try:
+    # torch.quantization is a deprecated alias for this and warns when used
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    from torch.quantization import quantize_dynamic
 
 from getconfig import settings, logger
 from story.utils import cut_trailing_sentence
@@ -12,43 +45,81 @@ from story.utils import cut_trailing_sentence
 DTYPE = torch.float32 if  ((not torch.cuda.is_available()) or settings.getboolean('force-cpu')) else torch.float16
 logger.info('Cuda Available: {}    Force CPU: {}    DTYPE: {}'.format(torch.cuda.is_available(), settings.getboolean('force-cpu'), DTYPE))
 
+# let any remaining fp32 matmuls use TensorCores on Ampere and newer
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+# skips autograd bookkeeping entirely, not just gradient tracking. New in PyTorch 1.9
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+# how many decoding steps between checks whether all samples hit a stop token
+STOP_CHECK_INTERVAL = 8
+
+# file name of an exported onnx graph inside a model directory, used instead of PyTorch when it exists
+ONNX_NAME = "model.onnx"
+
 # warnings.filterwarnings("ignore")
 MODEL_CLASSES = {
     "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
 }
 
 
-def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
-    """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
+def filtering_scratch(batch_size, top_k, dtype, device):
+    """Buffers reused by top_k_top_p_filtering_ between decoding steps: the sorted top-k values and indices, their
+    running probability sums, the nucleus threshold and the mask of removed candidates."""
+    return (
+        torch.empty(batch_size, top_k, dtype=dtype, device=device),
+        torch.empty(batch_size, top_k, dtype=torch.long, device=device),
+        torch.empty(batch_size, top_k, dtype=dtype, device=device),
+        torch.empty(batch_size, 1, dtype=dtype, device=device),
+        torch.empty(batch_size, top_k, dtype=torch.bool, device=device),
+    )
+
+
+def top_k_top_p_filtering_(logits, top_k=0, top_p=0.0, filter_value=-float("Inf"), scratch=None):
+    """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering, in place
         Args:
             logits: logits distribution shape (batch size x vocabulary size)
             top_k > 0: keep only top k tokens with highest probability (top-k filtering).
             top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
                 Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
+            scratch: buffers from filtering_scratch(batch size, top_k, ...), allocated here if missing or mismatched
         From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
     """
     top_k = min(top_k, logits.size(-1))  # Safety check
-    if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+    if top_k <= 0 and top_p <= 0.0:
+        return logits
+    if top_k <= 0:
+        # nucleus filtering over the whole sorted vocabulary
+        top_k = logits.size(-1)
+    if (
+        scratch is None
+        or scratch[0].shape != (logits.size(0), top_k)
+        or scratch[0].dtype != logits.dtype
+        or scratch[0].device != logits.device
+    ):
+        scratch = filtering_scratch(logits.size(0), top_k, logits.dtype, logits.device)
+    sorted_logits, sorted_indices, cumulative_probs, threshold, sorted_indices_to_remove = scratch
+
+    # Reduce to the top-k candidates first (already sorted by torch.topk) so the top-p
+    # softmax and cumsum run over k elements instead of the whole vocabulary
+    torch.topk(logits, top_k, out=(sorted_logits, sorted_indices))
 
     if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        # scatter sorted tensors to original indexing
-        indices_to_remove = sorted_indices_to_remove.scatter(
-            dim=1, index=sorted_indices, src=sorted_indices_to_remove
-        )
-        logits[indices_to_remove] = filter_value
-    return logits
+        # unnormalised softmax + cumsum: subtract the max (the first value), exp and sum up
+        torch.sub(sorted_logits, sorted_logits[..., :1], out=cumulative_probs)
+        cumulative_probs.exp_().cumsum_(dim=-1)
+        # cumulative probability above top_p is the same as cumulative sum above top_p * total
+        torch.mul(cumulative_probs[..., -1:], top_p, out=threshold)
+
+        # Remove tokens with cumulative probability above the threshold, shifted to the right
+        # to keep also the first token above the threshold
+        torch.gt(cumulative_probs[..., :-1], threshold, out=sorted_indices_to_remove[..., 1:])
+        sorted_indices_to_remove[..., 0] = False
+        sorted_logits.masked_fill_(sorted_indices_to_remove, filter_value)
+
+    # scatter the surviving candidates back to original indexing, everything else is filtered
+    return logits.fill_(filter_value).scatter_(dim=1, index=sorted_indices, src=sorted_logits)
 
 
 def sample_sequence(
@@ -66,79 +137,250 @@ def sample_sequence(
     xlm_lang=None,
     device="cpu",
     stop_tokens=None,
+    past_kwarg="past",
+    use_cache=False,
+    filter_scratch=None,
 ):
-    context = torch.tensor(context, dtype=torch.long, device=device)
+    context = torch.as_tensor(context, dtype=torch.long, device=device)
     context = context.unsqueeze(0).repeat(num_samples, 1)
-    generated = context
-    USE_PAST = True
+    # preallocate room for the prompt plus every new token instead of growing it with torch.cat each step
+    generated = context.new_empty(num_samples, context.size(1) + length)
+    generated[:, : context.size(1)].copy_(context)
+    pos = context.size(1)
+    # the first step feeds the whole prompt (prefill), after that only the newly sampled token goes in
+    # and attention runs against the cached keys/values of everything before it
     next_token = context
-    outputs = None
-    with torch.no_grad():
+    past = None
+    # tokens already present in each sample, updated as we go rather than rebuilt from `generated` every step
+    seen_mask = torch.zeros(
+        num_samples, model.config.vocab_size, dtype=torch.bool, device=device
+    )
+    seen_mask.scatter_(1, context, True)
+    if stop_tokens is not None:
+        stop_tokens = torch.as_tensor(stop_tokens, device=device)
+    # each sample runs until it has produced a stop token, rows that finish early get cut by the caller
+    finished = torch.zeros(num_samples, dtype=torch.bool, device=device)
+    with inference_mode():
         for j in range(length):
-            if USE_PAST:
-                past = outputs[1] if outputs is not None else None
-                inputs = {"input_ids": next_token, "past": past}
-            else:
-                inputs = {"input_ids": generated}
-
-            outputs = model(
-                **inputs
-            )  # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet/CTRL (cached hidden-states)
+            inputs = {"input_ids": next_token}
+            if past is not None:
+                inputs[past_kwarg] = past
+            if use_cache:
+                inputs["use_cache"] = True
+
+            outputs = model(**inputs)
+            past = outputs[1]
             next_token_logits = outputs[0][:, -1, :] / (
                 temperature if temperature > 0 else 1.0
             )
 
             # repetition penalty from CTRL (https://arxiv.org/abs/1909.05858)
-            for i in range(num_samples):
-                for k in set(generated[i].tolist()):
-                    next_token_logits[i, k] /= repetition_penalty
+            # done as one masked op on device, dividing positive logits and multiplying negative ones
+            next_token_logits = torch.where(
+                seen_mask,
+                torch.where(
+                    next_token_logits > 0,
+                    next_token_logits / repetition_penalty,
+                    next_token_logits * repetition_penalty,
+                ),
+                next_token_logits,
+            )
 
-            filtered_logits = top_k_top_p_filtering(
-                next_token_logits, top_k=top_k, top_p=top_p
-            ).float()
+            # stays in the model dtype, the softmax/cumsum only runs over the top-k candidates
+            filtered_logits = top_k_top_p_filtering_(
+                next_token_logits, top_k=top_k, top_p=top_p, scratch=filter_scratch
+            )
             if temperature == 0:  # greedy sampling:
                 next_token = torch.argmax(filtered_logits, dim=-1).unsqueeze(-1)
             else:
-                next_token = torch.multinomial(
-                    F.softmax(filtered_logits, dim=-1), num_samples=1
-                )
-            generated = torch.cat((generated, next_token), dim=1)
-            if (
-                (stop_tokens is not None)
-                and (j > 4)
-                and (next_token[0][0] in stop_tokens)
-            ):
+                # Gumbel-max trick: argmax(logits + Gumbel noise) is a sample from softmax(logits),
+                # so there is no need for the softmax + multinomial pass
+                u = torch.rand_like(filtered_logits, dtype=torch.float).clamp_(min=1e-20)
+                gumbel_noise = -torch.log(-torch.log(u))
+                next_token = torch.argmax(filtered_logits + gumbel_noise, dim=-1, keepdim=True)
+            generated[:, pos : pos + 1] = next_token
+            pos += 1
+            seen_mask.scatter_(1, next_token, True)
+            if (stop_tokens is not None) and (j > 4):
                 # Why the minimum tokens, j>X. Because sometimes the models starts with whitespace, which will strip away anyway. Having a minimum amount of tokens before we stop usually means we don't just stop because of "\n " or similar
-                logger.info(
-                    "Stopping generation as we found stop tokens. One of `%s`, in '%s'. token generated `%s`",
-                    stop_tokens,
-                    next_token,
-                    j,
+                finished |= (next_token == stop_tokens.view(1, -1)).any(-1)
+                # reading the flag back forces a host/device sync, so only check every few steps and let
+                # the GPU queue work ahead. Tokens generated after a stop token are cut off by the caller
+                if (j + 1) % STOP_CHECK_INTERVAL == 0 and finished.all():
+                    logger.info(
+                        "Stopping generation as we found stop tokens. One of `%s`, in '%s'. token generated `%s`",
+                        stop_tokens,
+                        next_token,
+                        j,
+                    )
+                    break
+    return generated[:, :pos]
+
+
+def conv1d_to_linear(model):
+    """Replace the transposed Conv1D layers GPT-2 uses with equivalent nn.Linear layers, in place."""
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            # matched by name since Conv1D moved between transformers modules over versions
+            if type(child).__name__ == "Conv1D":
+                nx, nf = child.weight.shape
+                # the weights get replaced right away, so don't spend time and memory initialising them
+                linear = torch.nn.utils.skip_init(torch.nn.Linear, nx, nf, device=child.weight.device)
+                linear.weight = torch.nn.Parameter(child.weight.data.t().contiguous())
+                linear.bias = torch.nn.Parameter(child.bias.data)
+                setattr(module, name, linear)
+    return model
+
+
+class StopOnTokens(StoppingCriteria):
+    """Stops model.generate once every sample has produced a stop token after the first min_length new tokens."""
+
+    # same as the j > 4 guard in sample_sequence
+    MIN_LENGTH = 5
+
+    def __init__(self, stop_tokens, prompt_length, min_length=MIN_LENGTH):
+        self.stop_tokens = stop_tokens
+        self.prompt_length = prompt_length
+        self.min_length = min_length
+        self.checked_length = 0
+        self.finished = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # look at every token added since the last call, assisted decoding can add several at once
+        start = max(self.prompt_length + self.min_length, self.checked_length)
+        self.checked_length = input_ids.size(1)
+        if start >= input_ids.size(1):
+            return False
+        hit = (input_ids[:, start:, None] == self.stop_tokens.view(1, 1, -1)).any(-1).any(-1)
+        self.finished = hit if self.finished is None else self.finished | hit
+        return bool(self.finished.all())
+
+
+class GPT2WithPast(torch.nn.Module):
+    """Wraps GPT2LMHeadModel as (input_ids, past_0, ...) -> (logits, present_0, ...) for exporting to onnx.
+
+    Each past/present is the stacked key and value of one layer, shape (2, batch, heads, seq, head size).
+    """
+
+    def __init__(self, model, past_kwarg="past"):
+        super().__init__()
+        self.model = model
+        self.past_kwarg = past_kwarg
+
+    def forward(self, input_ids, *past):
+        if self.past_kwarg == "past_key_values":
+            # newer transformers keep the key and value of each layer separate, the newest in a cache object
+            past = tuple((p[0], p[1]) for p in past)
+            if hasattr(DynamicCache, "from_legacy_cache"):
+                past = DynamicCache.from_legacy_cache(past)
+            elif DynamicCache is not None:
+                past = DynamicCache(past)
+        else:
+            past = list(past)
+        outputs = self.model(input_ids=input_ids, **{self.past_kwarg: past})
+        presents = outputs[1]
+        if hasattr(presents, "to_legacy_cache"):
+            presents = presents.to_legacy_cache()
+        elif hasattr(presents, "layers"):
+            presents = [(layer.keys, layer.values) for layer in presents.layers]
+        presents = [p if torch.is_tensor(p) else torch.stack(p) for p in presents]
+        return (outputs[0], *presents)
+
+
+class OnnxGPT2:
+    """Runs a graph exported by GPT2Generator.export_onnx with onnxruntime.
+
+    Called the same way sample_sequence calls the PyTorch model and returns (logits, past). Inputs and outputs are
+    bound to device memory with io binding, so the tokens, logits and cache never go through the host.
+    """
+
+    def __init__(self, path, config, device):
+        providers = [
+            p for p in ("CUDAExecutionProvider", "CPUExecutionProvider")
+            if p in onnxruntime.get_available_providers() and (device.type == "cuda" or p == "CPUExecutionProvider")
+        ]
+        self.session = onnxruntime.InferenceSession(str(path), providers=providers)
+        self.config = config
+        self.device = device
+        self.ort_device = "cuda" if self.session.get_providers()[0] == "CUDAExecutionProvider" else "cpu"
+        self.ort_device_id = (device.index or 0) if self.ort_device == "cuda" else 0
+        # where tensors are handed to onnxruntime, the cpu if only the cpu provider is installed
+        self.torch_device = device if self.ort_device == "cuda" else torch.device("cpu")
+        self.past_names = [i.name for i in self.session.get_inputs() if i.name.startswith("past_")]
+        self.past_dtype = np.float16 if self.session.get_inputs()[1].type == "tensor(float16)" else np.float32
+        self.logits_dtype = np.float16 if self.session.get_outputs()[0].type == "tensor(float16)" else np.float32
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def forward(self, input_ids, past=None):
+        if past is None:
+            # nothing cached yet, feed zero length pasts
+            shape = (2, input_ids.size(0), self.config.n_head, 0, self.config.n_embd // self.config.n_head)
+            past = [
+                onnxruntime.OrtValue.ortvalue_from_numpy(
+                    np.zeros(shape, dtype=self.past_dtype), self.ort_device, self.ort_device_id
                 )
-                break
-    return generated
+                for _ in self.past_names
+            ]
+        binding = self.session.io_binding()
+        input_ids = input_ids.to(self.torch_device).contiguous()
+        binding.bind_input(
+            "input_ids", self.ort_device, self.ort_device_id, np.int64, tuple(input_ids.shape), input_ids.data_ptr()
+        )
+        for name, value in zip(self.past_names, past):
+            binding.bind_ortvalue_input(name, value)
+
+        # onnxruntime writes the logits straight into a torch tensor, the presents stay as onnxruntime values
+        logits = torch.empty(
+            (input_ids.size(0), input_ids.size(1), self.config.vocab_size),
+            dtype=torch.float16 if self.logits_dtype == np.float16 else torch.float32,
+            device=self.torch_device,
+        )
+        binding.bind_output(
+            self.output_names[0], self.ort_device, self.ort_device_id, self.logits_dtype, tuple(logits.shape),
+            logits.data_ptr(),
+        )
+        for name in self.output_names[1:]:
+            binding.bind_output(name, self.ort_device, self.ort_device_id)
+
+        # onnxruntime runs on its own stream, make sure the input ids written by torch are there first
+        binding.synchronize_inputs()
+        self.session.run_with_iobinding(binding)
+        return logits.to(self.device), binding.get_outputs()[1:]
+
+    __call__ = forward
 
 
 def truncate_multiple_sequences(seqs, max_len=100):
     """Truncate multiple sequences, longest first, removing first."""
-    while sum(len(s) for s in seqs) > max_len:
-        longest = sorted(seqs, key=len, reverse=True)[0]
-        longest.pop(0)
+    excess = sum(len(s) for s in seqs) - max_len
+    if excess <= 0:
+        return
+    # count how many tokens to drop from each sequence with a heap of (-length, index), ties going to the
+    # earlier sequence, then drop them all with a single slice per sequence
+    heap = [(-len(s), i) for i, s in enumerate(seqs)]
+    heapq.heapify(heap)
+    remove = [0] * len(seqs)
+    for _ in range(excess):
+        neg_len, i = heap[0]
+        remove[i] += 1
+        heapq.heapreplace(heap, (neg_len + 1, i))
+    for s, n in zip(seqs, remove):
+        del s[:n]
 
 
 class GPT2Generator:
     def __init__(
-        self, generate_num=60, temperature=0.4, top_k=40, top_p=0.9, dtype=DTYPE, model_path=Path('models', 'pytorch-gpt2-xl-aid2-v5'), censor=False, repetition_penalty=1,
+        self, generate_num=60, temperature=0.4, top_k=40, top_p=0.9, dtype=DTYPE, model_path=Path('models', 'pytorch-gpt2-xl-aid2-v5'), censor=False, repetition_penalty=1, samples=1,
     ):
         self.generate_num = generate_num
         self.temp = temperature
         self.top_k = top_k
         self.top_p = top_p
         self.censor = censor
-        self.samples = 1
+        # number of completions generated together as one batch
+        self.samples = samples
         self.dtype = dtype
         self.repetition_penalty = repetition_penalty
-        self.batch_size = 1
         self.max_history_tokens = 1024 - generate_num
         self.stop_token = "<|endoftext|>"
 
@@ -155,28 +397,212 @@ class GPT2Generator:
         # Load tokenizer and model
         model_class, tokenizer_class = MODEL_CLASSES["gpt2"]
         self.tokenizer = tokenizer_class.from_pretrained(self.checkpoint_path)
-        self.model = model_class.from_pretrained(self.checkpoint_path)
-        self.model.to(self.dtype).to(self.device)
-        self.model.eval()
+        self.quantized = False
+        onnx_path = self.checkpoint_path / ONNX_NAME
+        if onnx_path.exists() and onnxruntime is not None:
+            # a graph made by export_onnx, the PyTorch weights are not loaded at all
+            logger.info("Using onnxruntime with {}".format(str(onnx_path)))
+            config = model_class.config_class.from_pretrained(self.checkpoint_path)
+            self.model = OnnxGPT2(onnx_path, config, self.device)
+        else:
+            if onnx_path.exists():
+                logger.warning("Found {} but onnxruntime is not installed, using PyTorch".format(str(onnx_path)))
+            self.model = model_class.from_pretrained(self.checkpoint_path)
+            self.model.to(self.dtype).to(self.device)
+            self.model.eval()
+
+            if self.device.type == "cpu" and self.dtype == torch.float32 and settings.getboolean("cpu-quantize", fallback=True):
+                # int8 weights for the linear layers, which are most of GPT-2's compute. Dynamic quantization only
+                # picks up nn.Linear so GPT-2's Conv1D layers are converted first. In place, so there is never a
+                # second fp32 copy of the model in memory
+                logger.info("Quantizing model to int8 for the cpu")
+                self.model = quantize_dynamic(
+                    conv1d_to_linear(self.model), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                )
+                self.quantized = True
+
+        # reusable host buffer for the prompt tokens, pinned so it can be copied to the GPU without blocking
+        self._ctx_host = torch.empty(
+            self.max_history_tokens, dtype=torch.long, pin_memory=(self.device.type == "cuda")
+        )
+
+        # buffers for top_k_top_p_filtering_ by batch size, so the per token filtering does not allocate
+        self._filter_scratch = {}
+
+        # stop tokens used for every story response, encoded once and kept on the device for the stop check
+        self._stop_token_ids = torch.tensor(
+            self.tokenizer.convert_tokens_to_ids(["<|endoftext|>", ">"]), device=self.device
+        )
+
+        # transformers renamed the `past` argument to `past_key_values` (and added `use_cache`) in later versions
+        forward_params = inspect.signature(self.model.forward).parameters
+        self.past_kwarg = "past_key_values" if "past_key_values" in forward_params else "past"
+        self.use_cache = "use_cache" in forward_params
+        # let transformers do the decoding when it is new enough, the onnx model only works with sample_sequence
+        self.use_generate = GenerationConfig is not None and not isinstance(self.model, OnnxGPT2)
+        if self.use_generate:
+            # generate() fills unset fields from the model's own generation_config, whose eos_token_id would stop
+            # at the first <|endoftext|> and skip the minimum length StopOnTokens enforces
+            self.model.generation_config.eos_token_id = None
+
+        # small model of the same family that drafts tokens for the big one to check (assisted decoding)
+        self.draft_model = None
+        draft_path = settings.get("draft-model", fallback="").strip()
+        if draft_path:
+            if self.samples > 1:
+                # transformers only supports assisted decoding for a single sample, it would never be used
+                logger.warning("draft-model only works with samples = 1, ignoring it")
+            elif self.use_generate and "assistant_model" in inspect.signature(self.model.generate).parameters:
+                logger.info("Loading draft model {}".format(draft_path))
+                self.draft_model = model_class.from_pretrained(draft_path)
+                self.draft_model.to(self.dtype).to(self.device)
+                self.draft_model.eval()
+                self.draft_model.generation_config.eos_token_id = None
+            else:
+                logger.warning("draft-model needs a newer version of transformers and a PyTorch model, ignoring it")
+
+        if settings.getboolean("compile-model", fallback=False) and not isinstance(self.model, OnnxGPT2):
+            if hasattr(torch, "compile") and self.device.type == "cuda":
+                # dynamic shapes since the prefill length and the cached past grow every step. Only forward is
+                # compiled so model.generate still goes through the compiled version
+                logger.info("Compiling model with torch.compile, the first generation will be slow")
+                self.model.forward = torch.compile(self.model.forward, dynamic=True, fullgraph=False)
+            else:
+                logger.warning("compile-model needs PyTorch 2.0+ and a GPU, running the model uncompiled")
+
+    def export_onnx(self, path=None):
+        """Export the model to an onnx graph with the past as inputs and outputs, by default into the model
+        directory so it gets picked up next time the generator is created."""
+        path = Path(path) if path is not None else self.checkpoint_path / ONNX_NAME
+        if isinstance(self.model, OnnxGPT2) or self.quantized:
+            raise RuntimeError("Can only export an unquantized PyTorch model, try again with cpu-quantize = off")
+        model = self.model
+        config = model.config
+        n_past = config.n_layer
+        past_shape = (2, 1, config.n_head, 1, config.n_embd // config.n_head)
+        dummy_inputs = (torch.zeros(1, 1, dtype=torch.long, device=self.device),) + tuple(
+            torch.zeros(past_shape, dtype=self.dtype, device=self.device) for _ in range(n_past)
+        )
+        input_names = ["input_ids"] + ["past_{}".format(i) for i in range(n_past)]
+        output_names = ["logits"] + ["present_{}".format(i) for i in range(n_past)]
+        dynamic_axes = {"input_ids": {0: "batch", 1: "seq"}, "logits": {0: "batch", 1: "seq"}}
+        dynamic_axes.update({"past_{}".format(i): {1: "batch", 3: "past_seq"} for i in range(n_past)})
+        dynamic_axes.update({"present_{}".format(i): {1: "batch", 3: "total_seq"} for i in range(n_past)})
+
+        # models over 2GB (gpt2-xl) need their weights stored outside the protobuf. Newer PyTorch does that on its own
+        export_kwargs = {}
+        export_params = inspect.signature(torch.onnx.export).parameters
+        if "use_external_data_format" in export_params:
+            export_kwargs["use_external_data_format"] = True
+        if "dynamo" in export_params:
+            # the dynamo exporter can't map dynamic_axes onto the varargs past, use the tracing one
+            export_kwargs["dynamo"] = False
+        # the fused sdpa attention path decides on causal masking from the traced shapes, so a graph traced with
+        # a single token would not mask the prompt. The eager path builds the mask from the shapes inside the graph
+        attn_implementation = None
+        if hasattr(model, "set_attn_implementation"):
+            attn_implementation = config._attn_implementation
+            model.set_attn_implementation("eager")
+        logger.info("Exporting onnx model to {}".format(str(path)))
+        with torch.no_grad():
+            torch.onnx.export(
+                GPT2WithPast(model, self.past_kwarg).eval(),
+                dummy_inputs,
+                str(path),
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                # PyTorch 2's fused attention needs opset 14, older PyTorch may not go past 11
+                opset_version=14 if hasattr(F, "scaled_dot_product_attention") else 11,
+                **export_kwargs
+            )
+        if attn_implementation is not None:
+            model.set_attn_implementation(attn_implementation)
+
+        # fuse attention, layernorm and gelu into single kernels if onnxruntime's transformer tools are around
+        try:
+            from onnxruntime.transformers import optimizer
+        except ImportError:
+            logger.warning("onnxruntime.transformers not found, saving the onnx model without fusing attention")
+        else:
+            optimized = optimizer.optimize_model(
+                str(path), model_type="gpt2", num_heads=config.n_head, hidden_size=config.n_embd
+            )
+            optimized.save_model_to_file(str(path), use_external_data_format=True)
+        return path
+
+    def generate_sequence(self, context, generate_num, temperature, stop_tokens=None, num_samples=1):
+        """Same as sample_sequence, but decoding is done by transformers' model.generate."""
+        input_ids = context.unsqueeze(0).repeat(num_samples, 1)
+        generation_config = GenerationConfig(
+            max_new_tokens=generate_num,
+            do_sample=temperature > 0,
+            temperature=temperature if temperature > 0 else 1.0,
+            top_k=self.top_k,
+            # top_p of 0 means off here, but would keep a single token in transformers
+            top_p=self.top_p if self.top_p > 0 else 1.0,
+            repetition_penalty=self.repetition_penalty,
+            pad_token_id=self.tokenizer.eos_token_id,
+            use_cache=True,
+        )
+        # the stop tokens are not passed as eos_token_id, that would stop before the minimum amount of tokens
+        stopping_criteria = StoppingCriteriaList()
+        if stop_tokens is not None:
+            stopping_criteria.append(
+                StopOnTokens(torch.as_tensor(stop_tokens, device=self.device), input_ids.size(1))
+            )
+        generate_kwargs = {}
+        if self.draft_model is not None and num_samples == 1:
+            # transformers only supports assisted decoding for a single sample
+            generate_kwargs["assistant_model"] = self.draft_model
+        with inference_mode():
+            out = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                generation_config=generation_config,
+                stopping_criteria=stopping_criteria,
+                **generate_kwargs
+            )
+        # only max_new_tokens or StopOnTokens should end generation, and StopOnTokens ignores the first few tokens
+        generated = out.size(1) - input_ids.size(1)
+        min_generated = min(generate_num, StopOnTokens.MIN_LENGTH + 1)
+        if generated < min_generated:
+            logger.warning(
+                "model.generate stopped after %s tokens, before its minimum of %s. Something other than the stop tokens ended generation",
+                generated,
+                min_generated,
+            )
+        return out
 
     def sample_sequence(
-        self, context_tokens=None, generate_num=None, temperature=None, stop_tokens=None
+        self, context_tokens=None, generate_num=None, temperature=None, stop_tokens=None, num_samples=None
     ):
         generate_num = generate_num if (generate_num is not None) else self.generate_num
         temperature = temperature if (temperature is not None) else self.temp
+        num_samples = num_samples if (num_samples is not None) else self.samples
+        # stage the prompt in the pinned host buffer so the copy to the GPU can be asynchronous
+        context = self._ctx_host[: len(context_tokens)]
+        context.copy_(torch.as_tensor(context_tokens, dtype=torch.long))
+        context = context.to(self.device, non_blocking=True)
+        if self.use_generate:
+            return self.generate_sequence(context, generate_num, temperature, stop_tokens, num_samples)
+        if self.top_k > 0 and num_samples not in self._filter_scratch:
+            self._filter_scratch[num_samples] = filtering_scratch(num_samples, self.top_k, self.dtype, self.device)
         out = sample_sequence(
             model=self.model,
-            context=context_tokens,
+            context=context,
             length=generate_num,
             # context=self.context,
             temperature=temperature,
             top_k=self.top_k,
             top_p=self.top_p,
             repetition_penalty=self.repetition_penalty,
-            num_samples=self.samples,
+            num_samples=num_samples,
             device=self.device,
             stop_tokens=stop_tokens,
-            # batch_size=self.batch_size,
+            past_kwarg=self.past_kwarg,
+            use_cache=self.use_cache,
+            filter_scratch=self._filter_scratch.get(num_samples),
         )
         return out
 
@@ -213,13 +639,34 @@ class GPT2Generator:
     def generate_raw(
         self, prompt, generate_num=None, temperature=None, stop_tokens=None
     ):
+        # only one text is returned, so only one row is decoded whatever the samples setting is
+        return self.generate_raw_samples(
+            prompt,
+            generate_num=generate_num,
+            temperature=temperature,
+            stop_tokens=stop_tokens,
+            num_samples=1,
+        )[0]
+
+    def generate_raw_samples(
+        self, prompt, generate_num=None, temperature=None, stop_tokens=None, num_samples=None
+    ):
+        """Like generate_raw, but returns the text of every sample in the batch, `samples` of them by default."""
         # the prompt is a list of strings, encode each one tok tokens, then truncate the longest ones
-        context_tokens = [
-            self.tokenizer.encode(
-                p, add_special_tokens=False, max_length=self.max_history_tokens
-            )
-            for p in prompt
-        ]
+        if isinstance(prompt, str):
+            prompt = [prompt]
+        if callable(self.tokenizer):
+            context_tokens = self.tokenizer(
+                prompt,
+                add_special_tokens=False,
+                truncation=True,
+                max_length=self.max_history_tokens,
+            )["input_ids"]
+        else:
+            # transformers before 3.0
+            context_tokens = self.tokenizer.batch_encode_plus(
+                prompt, add_special_tokens=False, max_length=self.max_history_tokens
+            )["input_ids"]
         truncate_multiple_sequences(context_tokens, self.max_history_tokens)
         context_tokens = list(itertools.chain(*context_tokens))
 
@@ -233,32 +680,38 @@ class GPT2Generator:
             ),
         )
 
-        generated = 0
-        for _ in range(self.samples // self.batch_size):
-            out = self.sample_sequence(
-                context_tokens,
-                generate_num=generate_num,
-                temperature=temperature,
-                stop_tokens=stop_tokens,
+        # all samples are generated in one batch
+        out = self.sample_sequence(
+            context_tokens,
+            generate_num=generate_num,
+            temperature=temperature,
+            stop_tokens=stop_tokens,
+            num_samples=num_samples,
+        )
+        out = out[:, len(context_tokens) :].tolist()
+        stop_ids = set(torch.as_tensor(stop_tokens).tolist()) if stop_tokens is not None else set()
+        texts = []
+        for o in out:
+            # samples in a batch stop at different steps, so cut each one after its own first stop token
+            stop_at = next((i for i, t in enumerate(o) if i > 4 and t in stop_ids), None)
+            if stop_at is not None:
+                o = o[: stop_at + 1]
+            text = self.tokenizer.decode(
+                o, clean_up_tokenization_spaces=True, skip_special_tokens=True
             )
-            out = out[:, len(context_tokens) :].tolist()
-            for o in out:
-                generated += 1
-                text = self.tokenizer.decode(
-                    o, clean_up_tokenization_spaces=True, skip_special_tokens=True
-                )
-                if self.stop_token:
+            if self.stop_token:
+                index = text.find(self.stop_token)
+                if index == -1:
+                    index = None
+                text = text[:index]
+            if stop_tokens is not None:
+                for stop_token in stop_tokens:
                     index = text.find(self.stop_token)
                     if index == -1:
                         index = None
                     text = text[:index]
-                if stop_tokens is not None:
-                    for stop_token in stop_tokens:
-                        index = text.find(self.stop_token)
-                        if index == -1:
-                            index = None
-                        text = text[:index]
-        return text
+            texts.append(text)
+        return texts
 
     def generate(self, prompt, options=None, seed=None, depth=0):
         logger.debug("BEFORE PROMPT_REPLACE: `%r`", prompt)
@@ -267,23 +720,28 @@ class GPT2Generator:
 
         # logger.debug("AFTER PROMPT_REPLACE is: `%r`", repr(prompt))
 
-        text = self.generate_raw(
-            prompt, stop_tokens=self.tokenizer.encode(["<|endoftext|>", ">"])
+        texts = self.generate_raw_samples(
+            prompt, stop_tokens=self._stop_token_ids
         )
 
-        logger.debug("Generated result is: `%r`", repr(text))
+        # use the first sample that is still non empty after formatting
+        for text in texts:
+            logger.debug("Generated result is: `%r`", repr(text))
 
-        result = self.result_replace(text)
+            result = self.result_replace(text)
 
-        if (depth > 6) and len(result) == 0:
-            # Sometimes it keeps generating a story startng with an action (">"), if it's tried a few times and it keeps
-            # happening, lets let it keep action text which starts in ">"
-            result = self.result_replace(text, allow_action=True)
-            logger.info(
-                "Model generated empty text after formatting `%r`. Trying to format less with allow_action=True. `%r`",
-                text,
-                result,
-            )
+            if (depth > 6) and len(result) == 0:
+                # Sometimes it keeps generating a story startng with an action (">"), if it's tried a few times and it keeps
+                # happening, lets let it keep action text which starts in ">"
+                result = self.result_replace(text, allow_action=True)
+                logger.info(
+                    "Model generated empty text after formatting `%r`. Trying to format less with allow_action=True. `%r`",
+                    text,
+                    result,
+                )
+
+            if len(result) > 0:
+                break
 
         if len(result) == 0:
             if depth < 20:
@@ -55,14 +55,24 @@ if termWidth < 5:
     logger.warning("Your detected terminal width is: "+str(get_terminal_size()[0]))
     termWidth = 999999999
 
+def getWrapWidth():
+    width = settings.getint("text-wrap-width")
+    width = 999999999 if width < 2 else width
+    return min(width, termWidth)
+
+# colPrint runs for every bit of output, so keep the width around instead of parsing the setting each time
+# updated when text-wrap-width is changed in game
+wrapWidth = getWrapWidth()
+
+# results at least this similar to the one before them mean the model started looping
+loopSimilarity = 0.9
+
 # ECMA-48 set graphics codes for the curious. Check out "man console_codes"
 def colPrint(text, col="0", wrap=True, end=None):
-    if wrap:
-        width = settings.getint("text-wrap-width")
-        width = 999999999 if width < 2 else width
-        width=min(width, termWidth)
+    # text that already fits in the width does not need wrapping
+    if wrap and len(text) > wrapWidth:
         text = textwrap.fill(
-            text, width, replace_whitespace=False
+            text, wrapWidth, replace_whitespace=False
         )
     print("\x1B[{}m{}\x1B[{}m".format(col, text, colors["default"]), end=end)
     return text.count('\n')+1
@@ -141,6 +151,7 @@ def getGenerator():
         top_k=settings.getint("top-keks"),
         top_p=settings.getfloat("top-p"),
         repetition_penalty=settings.getfloat("rep-pen"),
+        samples=settings.getint("samples"),
     )
 
 
@@ -183,7 +194,7 @@ class AIPlayer:
             action_prompt,
             generate_num=settings.getint("action-generate-num"),
             temperature=settings.getfloat("action-temp"),
-            stop_tokens=self.story_manager.generator.tokenizer.encode(["<|endoftext|>", "\n", ">"])
+            stop_tokens=self.story_manager.generator.tokenizer.convert_tokens_to_ids(["<|endoftext|>", "\n", ">"])
             # stop_tokens=self.generator.tokenizer.encode(['>', '<|endoftext|>'])
         )
         logger.info("get_action (mem_ind=%s, sample=%s, include_prompt=%s, predicate=`%r`) -> %r", mem_ind, sample, include_prompt, predicate, result_raw)
@@ -270,6 +281,7 @@ def d20ify_action(action, d):
     return action
 
 def play(generator):
+    global wrapWidth
     story_manager = UnconstrainedStoryManager(generator)
     ai_player = AIPlayer(story_manager)
     print("\n")
@@ -373,6 +385,8 @@ def play(generator):
                         )
                     )
                     settings[setRegex.group(1)] = setRegex.group(2)
+                    if setRegex.group(1) == "text-wrap-width":
+                        wrapWidth = getWrapWidth()
                     colPrint("Save config file?", colors["query"])
                     colPrint(
                         "Saving an invalid option will corrupt file!", colors["error"]
@@ -464,9 +478,9 @@ def play(generator):
 
                 if len(story_manager.story.results) >= 2:
                     similarity = get_similarity(
-                        story_manager.story.results[-1], story_manager.story.results[-2]
+                        story_manager.story.results[-1], story_manager.story.results[-2], threshold=loopSimilarity
                     )
-                    if similarity > 0.9:
+                    if similarity > loopSimilarity:
                         story_manager.story.actions = story_manager.story.actions[:-1]
                         story_manager.story.results = story_manager.story.results[:-1]
                         colPrint(
@@ -41,9 +41,15 @@ def console_print(text, width=75):
 
 # TODO: get rid if pyjarowinker dependency
 # (AOP) You could use a simpler method, but this has been reported by RebootTech as a much more accurate way to compare strings. It also helps clean up the history. So it will hurt ability to check for looping
-def get_similarity(a, b):
-    if len(a) == 0 or len(b) == 0:
+def get_similarity(a, b, threshold=None):
+    """Jaro-Winkler similarity. If a threshold is given, strings that can't be more similar than it return 0 early."""
+    if len(a) == 0 or len(b) == 0 or a == b:
         return 1
+    if threshold is not None:
+        # jaro is at most (2 + shorter/longer) / 3, and the winkler prefix bonus adds at most 4 * 0.1 of what is left
+        jaro_bound = (2 + min(len(a), len(b)) / max(len(a), len(b))) / 3
+        if jaro_bound + 0.4 * (1 - jaro_bound) <= threshold:
+            return 0
     return distance.get_jaro_distance(a, b, winkler=True, scaling=0.1)
 
 
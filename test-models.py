@@ -3,6 +3,8 @@
     #I can not figure out why. According to pythons documentation, only the current directory matters, not the placement of the file
 from getconfig import settings
 settings['log-level']=str(min(settings.getint('log-level'), 10))
+#compare against the full 32 bit model, not the int8 quantized one
+settings['cpu-quantize']='off'
 from gpt2generator import GPT2Generator
 import torch
 import numpy as np